@@ -1,13 +1,14 @@
 import collections
-from copy import copy
+from collections.abc import Iterable
+import functools
+import hashlib
 import inspect
 import logging
-import importlib
+import re
+import weakref
 
-from apispec import APISpec
-from apispec.ext.marshmallow.swagger import field2parameter
 import hug
-from marshmallow import fields, Schema
+from marshmallow import fields, missing, Schema
 from marshmallow.schema import SchemaMeta
 
 from yzconfig import YzConfig
@@ -26,32 +27,111 @@ class Settings(YzConfig):
     TESTING_MODE = False
     USE_DEFAULT_RESPONSE = True
     DESCRIPTION = ''
+    CACHE_MAX_AGE = 3600
 
 
 settings = Settings('SWAGGER_')
 del Settings
 
+CachedSpec = collections.namedtuple('CachedSpec', 'spec payload etag operations')
+
+_signatures = weakref.WeakKeyDictionary()
+
+# Schemas found in DEFINITIONS_PATH modules, dropped along with generated specs
+_definitions = {}
+swagger.on_clear(_definitions.clear)
+
+# Arguments hug fills in by itself
+_SKIP_PARAMETERS = frozenset(('request', 'response'))
+_DIRECTIVE_PREFIX = 'hug_'
+
+_PATH_PARAMETER = re.compile(r'{([^{}:]+)(?::[^{}]*)?}')
+
+# Fields whose swagger property depends on the field type only
+_PLAIN_FIELDS = (fields.Integer, fields.Float, fields.String, fields.Boolean, fields.UUID, fields.DateTime)
+_field_properties = {}
+
 
 def get_summary(description):
     return description.split('\n')[0]
 
 
-def where_is_parameter(name, url):
+def get_path_parameters(url):
+    return frozenset(_PATH_PARAMETER.findall(url))
+
+
+def where_is_parameter(name, path_parameters):
     # TODO: body, header
-    return 'path' if '{%s}' % name in url else 'query'
+    return 'path' if name in path_parameters else 'query'
+
+
+def get_versioned_urls(url, versions):
+    if isinstance(versions, str) or not isinstance(versions, Iterable):
+        versions = (versions,)
+    return tuple('/v{}{}'.format(version, url) if version else url for version in versions)
 
 
 def get_handler(interface):
     return interface.interface.spec
 
 
-def get_parameters(url, interface, spec):
+def get_signature(handler):
+    try:
+        return _signatures[handler]
+    except KeyError:
+        sig = _signatures[handler] = inspect.signature(handler)
+        return sig
+
+
+def is_plain_field(field):
+    return (
+        type(field) in _PLAIN_FIELDS and not field.validators and field.missing is missing and
+        not field.allow_none and not field.dump_only and not field.load_only and
+        set(field.metadata) <= {'location'}
+    )
+
+
+def get_field_property(field_type):
+    try:
+        return _field_properties[field_type]
+    except KeyError:
+        from apispec.ext.marshmallow.swagger import field2property
+
+        prop = _field_properties[field_type] = field2property(field_type(), use_refs=False)
+        return prop
+
+
+def get_field_parameter(field, name, location, required):
+    if is_plain_field(field):
+        parameter = {'in': location, 'name': name, 'required': required}
+        parameter.update(get_field_property(type(field)))
+        return parameter
+
+    from apispec.ext.marshmallow.swagger import field2parameter
+
+    field.metadata = {'location': location}
+    field.required = required
+    return field2parameter(field, name=name, default_in=location, use_refs=False)
+
+
+def get_parameter_names(interface):
+    # interface.parameters is per route (parameters=, map_params), not per handler
+    return tuple(
+        name for name in interface.parameters
+        if name not in _SKIP_PARAMETERS and not name.startswith(_DIRECTIVE_PREFIX)
+    )
+
+
+def get_parameters(url, interface, definitions, path_parameters):
+    names = get_parameter_names(interface)
+    if not names:
+        return ()
+
     defaults = interface.defaults
-    sig = inspect.signature(get_handler(interface))
+    sig = get_signature(get_handler(interface))
 
     parameters = []
-    for name in interface.parameters:
-
+    for name in names:
         parameter_type = sig.parameters[name].annotation
         if getattr(parameter_type, 'directive', False):
             logger.info('Skip directive: %s for url: %s ', name, url)
@@ -60,34 +140,18 @@ def get_parameters(url, interface, spec):
         if parameter_type != inspect.Parameter.empty:
             # path and query
             if isinstance(parameter_type, fields.Field):
-                parameter_place = where_is_parameter(name, url)
-                parameter_type.metadata = {
-                    'location': where_is_parameter(name, url)}
-                parameter_type.required = name not in defaults
-                parameter = field2parameter(
-                    parameter_type, name=name, default_in=parameter_place, use_refs=False)
+                parameter = get_field_parameter(
+                    parameter_type, name, where_is_parameter(name, path_parameters), name not in defaults)
                 if name in defaults:
                     parameter['default'] = defaults[name]
                 parameters.append(parameter)
             # body
-            elif name == 'body' and (isinstance(parameter_type, Schema) or isinstance(parameter_type, SchemaMeta)):
-                if isinstance(parameter_type, Schema):
-                    schema_name = parameter_type.__class__.__name__
-                    schema = parameter_type
-                elif isinstance(parameter_type, SchemaMeta):
-                    schema_name = parameter_type.__name__
-                    schema = parameter_type()
-
-                spec.definition(schema_name, schema=schema)
-
-                ref_definition = "#/definitions/{}".format(schema_name)
-                ref_schema = {"$ref": ref_definition}
-
+            elif name == 'body' and isinstance(parameter_type, (Schema, SchemaMeta)):
                 parameters.append({
                     "in": "body",
                     "name": "body",
                     "required": True,
-                    "schema": ref_schema
+                    "schema": get_schema_ref(parameter_type, definitions)
                 })
 
             else:
@@ -100,48 +164,97 @@ def get_parameters(url, interface, spec):
     return parameters
 
 
-def get_operation(interface, spec, use_default_response):
+@functools.lru_cache(maxsize=1024)
+def get_ref(name):
+    # One shared object per definition, refs are never modified once built
+    return {'$ref': '#/definitions/{}'.format(name)}
+
+
+def get_schema_ref(schema, definitions):
+    if isinstance(schema, str):  # schema name provided
+        name = schema
+    elif isinstance(schema, Schema):  # schema instance provided
+        name = schema.__class__.__name__
+        definitions[name] = schema
+    elif isinstance(schema, SchemaMeta):  # schema class provided
+        name = schema.__name__
+        definitions[name] = schema
+    else:
+        logger.error('Wrong response schema %s', schema)
+        return None
+
+    return get_ref(name)
+
+
+def get_response(response, definitions):
+    result = {key: value for key, value in response.items() if key != 'schema'}
+    if 'schema' in response:
+        ref_schema = get_schema_ref(response['schema'], definitions)
+        if ref_schema is not None:
+            result['schema'] = ref_schema
+    return result
+
+
+def get_operation(interface, definitions, use_default_response):
     handler = get_handler(interface)
-    sig = inspect.signature(handler)  # type: Signature
+    sig = get_signature(handler)  # type: Signature
     annotated_response_schema = sig.return_annotation
-    responses = copy(getattr(handler, 'swagger_responses', {}))
+
+    responses = {
+        code: get_response(response, definitions)
+        for code, response in getattr(handler, 'swagger_responses', {}).items()
+    }
 
     if annotated_response_schema != inspect.Parameter.empty:
-        responses.setdefault(200, {})['schema'] = annotated_response_schema
+        ref_schema = get_schema_ref(annotated_response_schema, definitions)
+        if ref_schema is not None:
+            responses.setdefault(200, {})['schema'] = ref_schema
 
     if use_default_response:
         responses.setdefault(200, {})  # TODO: get: 200, post: 201
 
-    for code, response in responses.items():
-        response = copy(response)
-        try:
-            schema = response['schema']
-            if isinstance(schema, str):  # schema name provided
-                name = schema
-            elif isinstance(schema, Schema):  # schema instance provided
-                name = schema.__class__.__name__
-                spec.definition(name, schema=schema)
-            elif isinstance(schema, SchemaMeta):  # schema class provided
-                name = schema.__name__
-                spec.definition(name, schema=schema())
-            else:
-                logger.error('Wrong response schema %s', schema)
-                schema = None
-        except KeyError:
-            pass
-        else:
-            if schema is not None:
-                ref_name = '#/definitions/{}'.format(name)
-                ref_schema = {'$ref': ref_name}
-                response["schema"] = ref_schema
-            responses[code] = response
-
     return responses
 
 
-@hug.get('/swagger.json')
-def swagger_json(hug_api):
-    spec = APISpec(
+def load_definitions(path):
+    try:
+        return _definitions[path]
+    except KeyError:
+        import importlib
+
+        definitions = importlib.import_module(path)
+        loaded = _definitions[path] = tuple(
+            (name, schema) for name, schema in definitions.__dict__.items()  # type: str, Schema
+            if name.endswith('Schema') and len(name) > len('Schema')
+        )
+        return loaded
+
+
+def get_method_data(url, interface, definitions, path_parameters):
+    # Read the docstring and content type directly: interface.documentation()
+    # also renders every input of the handler, which is not used here
+    usage = get_handler(interface).__doc__
+    methods_data = {'content_type': interface.outputs.content_type}
+
+    if usage:
+        methods_data['summary'] = get_summary(usage)
+        methods_data['description'] = usage
+
+    parameters = get_parameters(url, interface, definitions, path_parameters)
+    if parameters:
+        methods_data['parameters'] = parameters
+
+    responses = get_operation(interface, definitions, settings.USE_DEFAULT_RESPONSE)
+    if responses:
+        methods_data['responses'] = responses
+
+    return methods_data
+
+
+def create_spec():
+    from apispec import APISpec
+
+    return APISpec(
         title=settings.TITLE,
         description=settings.DESCRIPTION,
         version=settings.VERSION,
@@ -152,48 +265,96 @@ def swagger_json(hug_api):
         host=settings.HOST
     )
 
-    if settings.DEFINITIONS_PATH is not None:
-        definitions = importlib.import_module(settings.DEFINITIONS_PATH)
 
-        for name, schema in definitions.__dict__.items():  # type: str, Schema
-            if name.endswith('Schema') and len(name) > len('Schema'):
-                spec.definition(name, schema=schema)
+def generate_spec(hug_api, operations=None, known_operations=None):
+    # Operations are collected per (url, interface), ones found in known_operations are not built again
+    operations = {} if operations is None else operations
+    known_operations = {} if known_operations is None else known_operations
+    spec = create_spec()
+
+    # Schemas are registered once at the end, however many routes use them
+    definitions = {}
+    if settings.DEFINITIONS_PATH is not None:
+        definitions.update(load_definitions(settings.DEFINITIONS_PATH))
 
     routes = hug_api.http.routes['']
 
     for url, route in routes.items():
+        path_parameters = get_path_parameters(url)
+        versioned_urls = {}
         for method, versioned_interfaces in route.items():
             for versions, interface in versioned_interfaces.items():
-                methods_data = {}
+                if getattr(get_handler(interface), 'swagger_excluded', False):
+                    continue
 
-                documentation = interface.documentation()
-                methods_data['content_type'] = documentation['outputs']['content_type']
+                try:
+                    methods_data, handler_definitions = known_operations[url, interface]
+                except KeyError:
+                    handler_definitions = {}
+                    methods_data = get_method_data(url, interface, handler_definitions, path_parameters)
+                operations[url, interface] = methods_data, handler_definitions
+                definitions.update(handler_definitions)
 
                 try:
-                    methods_data['summary'] = get_summary(
-                        documentation['usage'])
-                    methods_data['description'] = documentation['usage']
+                    urls = versioned_urls[versions]
                 except KeyError:
-                    pass
+                    urls = versioned_urls[versions] = get_versioned_urls(url, versions)
 
-                parameters = get_parameters(url, interface, spec)
-                if parameters:
-                    methods_data['parameters'] = parameters
+                for versioned_url in urls:
+                    spec.add_path(versioned_url, operations={
+                        method.lower(): dict(methods_data)
+                    })
 
-                responses = get_operation(
-                    interface, spec, settings.USE_DEFAULT_RESPONSE)
-                if responses:
-                    methods_data['responses'] = responses
+    for name, schema in definitions.items():
+        spec.definition(name, schema=schema)
 
-                if not isinstance(versions, collections.Iterable):
-                    versions = [versions]
+    return spec.to_dict()
 
-                for version in versions:
-                    versioned_url = '/v{}{}'.format(version,
-                                                    url) if version else url
 
-                    spec.add_path(versioned_url, operations={
-                        method.lower(): methods_data
-                    })
+@hug.format.content_type('application/json; charset=utf-8')
+def json_payload(content, **kwargs):
+    """JSON already serialized to bytes"""
+    return content
 
-    return spec.to_dict()
+
+def build_spec(hug_api, previous=None):
+    # New routes come with new interfaces, so operations of a previous build stay valid
+    operations = {}
+    spec = generate_spec(hug_api, operations, previous.operations if previous is not None else None)
+    payload = hug.output_format.json(spec)
+    etag = '"{}"'.format(hashlib.blake2b(payload, digest_size=16).hexdigest())
+    return CachedSpec(spec, payload, etag, operations)
+
+
+def etag_matches(if_none_match, etag):
+    # Weak comparison as in RFC 7232, section 3.2
+    if not if_none_match:
+        return False
+
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate == '*':
+            return True
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+@hug.get('/swagger.json', output=json_payload)
+def swagger_json(hug_api, request, response):
+    key = (
+        id(hug_api), settings.TITLE, settings.DESCRIPTION, settings.VERSION, settings.HOST,
+        tuple(settings.SCHEMES), settings.USE_DEFAULT_RESPONSE, settings.DEFINITIONS_PATH,
+    )
+    cached = swagger.cached_spec(key, functools.partial(build_spec, hug_api))
+
+    response.set_header('Cache-Control', 'public, max-age={}'.format(settings.CACHE_MAX_AGE))
+    response.set_header('ETag', cached.etag)
+
+    if etag_matches(request.get_header('If-None-Match'), cached.etag):
+        response.status = hug.HTTP_304
+        return b''
+
+    return cached.payload
@@ -1,3 +1,88 @@
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class _SpecCache(object):
+    """A generated spec which is rebuilt in background and swapped as a whole"""
+
+    def __init__(self, build, reset):
+        self.build = build
+        self.reset = reset
+        self.current = build(None)
+        self._lock = threading.Lock()
+        self._rebuilding = False
+        self._pending = False
+
+    def refresh(self):
+        with self._lock:
+            if self._rebuilding:
+                # The running build may have read the old routes already, run it again once it finishes
+                self._pending = True
+                return
+            self._rebuilding = True
+
+        try:
+            threading.Thread(target=self._rebuild, daemon=True).start()
+        except Exception:
+            with self._lock:
+                self._rebuilding = self._pending = False
+            raise
+
+    def _rebuild(self):
+        while True:
+            with self._lock:
+                self._pending = False
+
+            self.reset()
+            try:
+                self.current = self.build(self.current)
+            except Exception:
+                logger.exception('Failed to rebuild swagger spec')
+
+            with self._lock:
+                if not self._pending:
+                    self._rebuilding = False
+                    return
+
+
+_spec_cache = {}
+_clear_callbacks = []
+
+
+def _reset():
+    for callback in _clear_callbacks:
+        callback()
+
+
+def cached_spec(key, build):
+    """Spec stored under the key, build(previous) is called on the first request and on refresh"""
+    try:
+        cache = _spec_cache[key]
+    except KeyError:
+        cache = _spec_cache[key] = _SpecCache(build, reset=_reset)
+    return cache.current
+
+
+def on_clear(callback):
+    """Register a callback dropping data cached along with generated specs"""
+    _clear_callbacks.append(callback)
+    return callback
+
+
+def clear_cache():
+    """Drop generated specs, they will be rebuilt on the next request"""
+    _spec_cache.clear()
+    _reset()
+
+
+def schedule_refresh():
+    """Rebuild generated specs in background, current ones are served until then"""
+    for cache in list(_spec_cache.values()):
+        cache.refresh()
+
+
 def response(response_code, schema=None, description=None):
     """A decorator that add swagger response"""
 
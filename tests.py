@@ -0,0 +1,392 @@
+import logging
+import subprocess
+import sys
+import threading
+import time
+
+from apispec.ext.marshmallow import swagger as marshmallow_swagger
+from apispec.ext.marshmallow.swagger import field2parameter
+import hug
+from marshmallow import fields, validate
+import pytest
+
+import hug_swagger
+from hug_swagger import swagger
+import testingschemas
+
+
+@pytest.fixture
+def api(request):
+    api = hug.API('tests_{}'.format(request.node.name))
+    api.extend(hug_swagger, '')
+
+    @hug.get('/users/{user_id}', api=api)
+    def get_user(user_id: fields.Integer()):
+        """Get user"""
+
+    swagger.clear_cache()
+    yield api
+    swagger.clear_cache()
+
+
+def get_spec(api, headers=None):
+    return hug.test.get(api, '/swagger.json', headers=headers or {})
+
+
+def add_route(api):
+    @hug.get('/added', api=api)
+    def added():
+        pass
+
+
+def test_swagger_json(api):
+    response = get_spec(api)
+
+    assert response.status == hug.HTTP_200
+    assert response.data['paths']['/users/{user_id}']['get']['summary'] == 'Get user'
+
+
+def test_clear_cache(api):
+    get_spec(api)
+    add_route(api)
+    assert '/added' not in get_spec(api).data['paths']
+
+    swagger.clear_cache()
+
+    assert '/added' in get_spec(api).data['paths']
+
+
+def test_cache_headers(api):
+    response = get_spec(api)
+
+    assert response.headers_dict['cache-control'] == 'public, max-age=3600'
+    assert response.headers_dict['etag']
+    assert get_spec(api).headers_dict['etag'] == response.headers_dict['etag']
+
+
+def test_cache_max_age(api, monkeypatch):
+    monkeypatch.setattr(hug_swagger.settings, 'CACHE_MAX_AGE', 60)
+
+    assert get_spec(api).headers_dict['cache-control'] == 'public, max-age=60'
+
+
+@pytest.mark.parametrize('field_type', hug_swagger._PLAIN_FIELDS)
+@pytest.mark.parametrize('location', ['path', 'query'])
+@pytest.mark.parametrize('required', [True, False])
+def test_plain_field_parameter(field_type, location, required):
+    field = field_type()
+    assert hug_swagger.is_plain_field(field)
+
+    expected = field2parameter(
+        field_type(required=required, location=location), name='value', default_in=location, use_refs=False)
+    assert hug_swagger.get_field_parameter(field, 'value', location, required) == expected
+
+
+@pytest.mark.parametrize('field', [
+    fields.Integer(validate=validate.Range(min=1)),
+    fields.Integer(allow_none=True),
+    fields.String(description='Name'),
+    fields.Email(),
+])
+def test_field_parameter_with_options(field, monkeypatch):
+    calls = []
+
+    def spy(*args, **kwargs):
+        calls.append(args)
+        return field2parameter(*args, **kwargs)
+
+    monkeypatch.setattr(marshmallow_swagger, 'field2parameter', spy)
+
+    assert not hug_swagger.is_plain_field(field)
+    hug_swagger.get_field_parameter(field, 'value', 'query', True)
+    assert calls == [(field,)]
+
+
+def test_field_parameters(api):
+    @hug.get('/items/{item_id}', api=api)
+    def get_item(item_id: fields.Integer(), limit: fields.Integer() = 10):
+        pass
+
+    parameters = get_spec(api).data['paths']['/items/{item_id}']['get']['parameters']
+
+    assert parameters == [
+        {'in': 'path', 'name': 'item_id', 'required': True, 'type': 'integer', 'format': 'int32'},
+        {'in': 'query', 'name': 'limit', 'required': False, 'type': 'integer', 'format': 'int32', 'default': 10},
+    ]
+
+
+def test_path_parameter_with_converter(api):
+    @hug.get('/orders/{order_id:int}', api=api)
+    def get_order(order_id: fields.Integer(), page: fields.Integer() = 1):
+        pass
+
+    parameters = get_spec(api).data['paths']['/orders/{order_id:int}']['get']['parameters']
+
+    assert [(parameter['name'], parameter['in']) for parameter in parameters] == [
+        ('order_id', 'path'), ('page', 'query')]
+
+
+def test_apispec_imported_lazily():
+    code = 'import sys, hug_swagger; assert "apispec" not in sys.modules'
+    subprocess.check_call([sys.executable, '-c', code])
+
+
+def test_exclude(api):
+    @hug.get('/hidden', api=api)
+    @swagger.exclude()
+    def hidden():
+        pass
+
+    assert '/hidden' not in get_spec(api).data['paths']
+
+
+def test_definitions(api, monkeypatch):
+    monkeypatch.setattr(hug_swagger.settings, 'DEFINITIONS_PATH', 'testingschemas')
+
+    assert sorted(get_spec(api).data['definitions']) == ['TestingFieldsSchema', 'TestingSchema']
+
+
+def test_definitions_after_clear_cache(api, monkeypatch):
+    monkeypatch.setattr(hug_swagger.settings, 'DEFINITIONS_PATH', 'testingschemas')
+    get_spec(api)
+
+    class AddedSchema(testingschemas.Schema):
+        name = fields.String()
+
+    monkeypatch.setattr(testingschemas, 'AddedSchema', AddedSchema, raising=False)
+    swagger.clear_cache()
+
+    assert 'AddedSchema' in get_spec(api).data['definitions']
+
+
+def test_operation_documentation(api):
+    @hug.get('/text', api=api, output=hug.output_format.text)
+    def text():
+        """Plain text
+
+        Longer description"""
+
+    operation = get_spec(api).data['paths']['/text']['get']
+
+    assert operation['content_type'] == 'text/plain; charset=utf-8'
+    assert operation['summary'] == 'Plain text'
+    assert operation['description'] == 'Plain text\n\n        Longer description'
+
+
+def test_skip_hug_arguments(api, caplog):
+    @hug.post('/notes', api=api)
+    def create_note(text: fields.String(), request, response, hug_timer=3):
+        pass
+
+    caplog.set_level(logging.INFO, logger='hug_swagger')
+    parameters = get_spec(api).data['paths']['/notes']['post']['parameters']
+
+    assert [parameter['name'] for parameter in parameters] == ['text']
+    assert not [record for record in caplog.records if '/notes' in record.getMessage()]
+
+
+class NoteSchema(testingschemas.Schema):
+    text = fields.String()
+
+
+def test_schema_definitions(api):
+    @hug.post('/notes', api=api)
+    @swagger.response(201, schema=NoteSchema(), description='Created')
+    def create_note(body: NoteSchema) -> NoteSchema:
+        pass
+
+    @hug.get('/notes/latest', api=api)
+    @swagger.response(404, schema='NoteSchema')
+    def latest_note() -> NoteSchema():
+        pass
+
+    spec = get_spec(api).data
+    ref = {'$ref': '#/definitions/NoteSchema'}
+    create, latest = spec['paths']['/notes']['post'], spec['paths']['/notes/latest']['get']
+
+    assert spec['definitions'] == {'NoteSchema': {'type': 'object', 'properties': {'text': {'type': 'string'}}}}
+    assert create['parameters'] == [{'in': 'body', 'name': 'body', 'required': True, 'schema': ref}]
+    assert create['responses'] == {'200': {'schema': ref}, '201': {'schema': ref, 'description': 'Created'}}
+    assert latest['responses'] == {'200': {'schema': ref}, '404': {'schema': ref}}
+
+
+def test_versioned_urls(api):
+    @hug.get('/status', versions=(1, 2), api=api)
+    def status():
+        pass
+
+    @hug.get('/health', api=api)
+    def health():
+        pass
+
+    paths = get_spec(api).data['paths']
+
+    assert {'/v1/status', '/v2/status', '/health'} <= set(paths)
+    assert '/status' not in paths
+    assert hug_swagger.get_versioned_urls('/info', '3') == ('/v3/info',)
+    assert hug_swagger.get_versioned_urls('/info', None) == ('/info',)
+
+
+@pytest.mark.parametrize('if_none_match', ['{}', 'W/{}', '"other", {}', '*'])
+def test_not_modified(api, if_none_match):
+    etag = get_spec(api).headers_dict['etag']
+
+    response = get_spec(api, {'If-None-Match': if_none_match.format(etag)})
+
+    assert response.status == hug.HTTP_304
+    assert response.headers_dict['etag'] == etag
+
+
+def test_etag_mismatch(api):
+    get_spec(api)
+
+    response = get_spec(api, {'If-None-Match': '"other", W/"another"'})
+
+    assert response.status == hug.HTTP_200
+    assert '/users/{user_id}' in response.data['paths']
+
+
+def test_parameters_per_route(api):
+    def search(x: fields.String(), y: fields.String() = ''):
+        pass
+
+    hug.get('/s1', parameters=['x'], api=api)(search)
+    hug.get('/s2', parameters=['y'], api=api)(search)
+    hug.get('/s3', api=api)(search)
+    paths = get_spec(api).data['paths']
+
+    def names(url):
+        return [parameter['name'] for parameter in paths[url]['get']['parameters']]
+
+    assert names('/s1') == ['x']
+    assert names('/s2') == ['y']
+    assert names('/s3') == ['x', 'y']
+
+
+def test_no_parameters(api):
+    @hug.get('/ping', api=api)
+    def ping(request, response):
+        pass
+
+    assert 'parameters' not in get_spec(api).data['paths']['/ping']['get']
+
+
+def test_shared_schema_refs(api):
+    @hug.post('/notes', api=api)
+    def create_note(body: NoteSchema) -> NoteSchema:
+        pass
+
+    @hug.get('/notes/latest', api=api)
+    def latest_note() -> NoteSchema:
+        pass
+
+    paths = hug_swagger.generate_spec(api)['paths']
+    refs = [
+        paths['/notes']['post']['parameters'][0]['schema'],
+        paths['/notes']['post']['responses'][200]['schema'],
+        paths['/notes/latest']['get']['responses'][200]['schema'],
+    ]
+
+    assert refs[0] == {'$ref': '#/definitions/NoteSchema'}
+    assert all(ref is refs[0] for ref in refs)
+
+
+def wait_for(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert predicate()
+
+
+def test_schedule_refresh(api):
+    etag = get_spec(api).headers_dict['etag']
+    add_route(api)
+
+    swagger.schedule_refresh()
+
+    wait_for(lambda: get_spec(api).headers_dict['etag'] != etag)
+    assert '/added' in get_spec(api).data['paths']
+
+
+def test_refresh_during_rebuild():
+    builds, release = [], threading.Event()
+
+    def build(previous):
+        builds.append(previous)
+        if len(builds) == 2:
+            release.wait(5)
+        return len(builds)
+
+    cache = swagger._SpecCache(build, reset=lambda: None)
+    cache.refresh()
+    wait_for(lambda: len(builds) == 2)
+
+    cache.refresh()  # requested while the second build is still running
+    release.set()
+
+    wait_for(lambda: not cache._rebuilding)
+    assert cache.current == 3
+
+
+def test_refresh_when_thread_fails_to_start(monkeypatch):
+    cache = swagger._SpecCache(lambda previous: object(), reset=lambda: None)
+    current = cache.current
+
+    class BrokenThread(threading.Thread):
+        def start(self):
+            raise RuntimeError("can't start new thread")
+
+    monkeypatch.setattr(swagger.threading, 'Thread', BrokenThread)
+    with pytest.raises(RuntimeError):
+        cache.refresh()
+
+    monkeypatch.undo()
+    cache.refresh()
+    wait_for(lambda: cache.current is not current)
+
+
+def test_schedule_refresh_reloads_definitions(api, monkeypatch):
+    monkeypatch.setattr(hug_swagger.settings, 'DEFINITIONS_PATH', 'testingschemas')
+    get_spec(api)
+    monkeypatch.setattr(testingschemas, 'AddedSchema', NoteSchema, raising=False)
+
+    swagger.schedule_refresh()
+
+    wait_for(lambda: 'AddedSchema' in get_spec(api).data['definitions'])
+
+
+def test_refresh_reuses_operations(api, monkeypatch):
+    get_spec(api)
+    add_route(api)
+    built = []
+
+    def get_method_data(url, *args):
+        built.append(url)
+        return original(url, *args)
+
+    original = hug_swagger.get_method_data
+    monkeypatch.setattr(hug_swagger, 'get_method_data', get_method_data)
+    etag = get_spec(api).headers_dict['etag']
+
+    swagger.schedule_refresh()
+
+    wait_for(lambda: get_spec(api).headers_dict['etag'] != etag)
+    assert built == ['/added']
+
+
+def test_operations_keyed_by_interface(api):
+    def greet(name: fields.String(), title: fields.String() = ''):
+        pass
+
+    text_api = hug.API('tests_text_api')
+    hug.get('/greet', api=api)(greet)
+    hug.get('/greet', api=text_api, output=hug.output_format.text, parameters=['title'])(greet)
+
+    operations = {}
+    operation = hug_swagger.generate_spec(api, operations)['paths']['/greet']['get']
+    text_operation = hug_swagger.generate_spec(text_api, known_operations=operations)['paths']['/greet']['get']
+
+    assert operation['content_type'] == 'application/json; charset=utf-8'
+    assert [parameter['name'] for parameter in operation['parameters']] == ['name', 'title']
+    assert text_operation['content_type'] == 'text/plain; charset=utf-8'
+    assert [parameter['name'] for parameter in text_operation['parameters']] == ['title']